@@ -0,0 +1,152 @@
+# compression.py
+import gzip
+import json
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from core.config import settings
+from db import invalidation
+
+# Brotli is optional; without it responses are only gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+# Compress a body with an encoding
+def compress(body: bytes, encoding: str):
+    if encoding == "br":
+        return brotli.compress(body, quality=settings.brotli_quality)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=settings.gzip_level)
+    return body
+
+# Pick the best encoding the client accepts, or "identity"
+def choose_encoding(accept_encoding: str):
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return "identity"
+
+# Merge Accept-Encoding into the values of a response's Vary headers, keeping what the app varies on already
+def merge_vary(values):
+    fields = [field.strip() for value in values for field in value.decode().split(",") if field.strip()]
+    if not any(field == "*" or field.lower() == "accept-encoding" for field in fields):
+        fields.append("Accept-Encoding")
+    return ", ".join(fields)
+
+# Define a middleware that compresses large responses that are not compressed already
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode().lower(): value.decode() for key, value in scope["headers"]}
+        encoding = choose_encoding(headers.get("accept-encoding", ""))
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                # Hold the start until the body shows whether it is worth compressing
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            if start is not None:
+                response_headers = {key.decode().lower(): value.decode() for key, value in start["headers"]}
+                body = message.get("body", b"")
+                # Only whole bodies are compressed; streamed responses are passed through
+                if (
+                    message.get("more_body", False)
+                    or "content-encoding" in response_headers
+                    or len(body) < self.minimum_size
+                    or not response_headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+                ):
+                    passthrough = True
+                    await send(start)
+                    start = None
+                    await send(message)
+                    return
+                body = compress(body, encoding)
+                raw_headers = [
+                    (key, value) for key, value in start["headers"] if key.lower() not in (b"content-length", b"vary")
+                ]
+                raw_headers += [
+                    (b"content-encoding", encoding.encode()),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"vary", merge_vary(value for key, value in start["headers"] if key.lower() == b"vary").encode()),
+                ]
+                await send({**start, "headers": raw_headers})
+                start = None
+                await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+# Cache of listing bodies by (entity, version, path, query), each holding the body in every encoding used so far
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# Bumped whenever an entity changes, so cached listings of it are never served again
+_versions = {"product": 0, "user": 0}
+
+@invalidation.subscribe("product")
+def _bump_product_version(key: str):
+    _versions["product"] += 1
+
+@invalidation.subscribe("user")
+def _bump_user_version(key: str):
+    _versions["user"] += 1
+
+# Define a function to serve a JSON listing from the cache of precompressed bodies, building it on a miss
+def cached_json(request: Request, entity: str, build):
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    key = (entity, _versions[entity], request.url.path, tuple(sorted(request.query_params.multi_items())))
+    now = time.time()
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and entry["expires_at"] > now:
+            _cache.move_to_end(key)
+        else:
+            entry = None
+    if entry is None:
+        body = json.dumps(jsonable_encoder(build()), ensure_ascii=False, separators=(",", ":")).encode()
+        entry = {"expires_at": now + settings.response_cache_ttl_seconds, "identity": body}
+        with _cache_lock:
+            _cache[key] = entry
+            while len(_cache) > settings.response_cache_size:
+                _cache.popitem(last=False)
+    if encoding != "identity" and len(entry["identity"]) < settings.compression_min_size:
+        encoding = "identity"
+    if encoding not in entry:
+        entry[encoding] = compress(entry["identity"], encoding)
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=entry[encoding], media_type="application/json", headers=headers)
+
@@ -1,7 +1,7 @@
 # auth.py
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from typing import Optional
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import timedelta
 from core.security import (
     authenticate_user,
     create_access_token,
@@ -9,17 +9,16 @@ from core.security import (
     get_current_user,
     get_password_hash,
 )
-from services.email import (
-    send_verification_email,
-    send_password_reset_email,
-)
+from services import jobs
+from core.config import settings
 from db import crud, schemas
+from api import compression
 
 router = APIRouter()
 
 # Define an endpoint for user registration
 @router.post("/register", response_model=schemas.User)
-def register(background_tasks: BackgroundTasks, user: schemas.UserCreate):
+def register(user: schemas.UserCreate):
     # Check if the username or email already exists in the database
     if crud.get_user_by_username(user.username) or crud.get_user_by_email(user.email):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username or email already taken")
@@ -35,10 +34,8 @@ def register(background_tasks: BackgroundTasks, user: schemas.UserCreate):
     )
     # Save the new user in the database
     user = crud.create_user(new_user)
-    # Generate a verification token with the user key as the payload
-    token = create_access_token(user.key)
-    # Send a verification email to the user with the token as a link
-    background_tasks.add_task(send_verification_email, user.email, token)
+    # Queue a verification email to the user; the job generates the token, so it is not stored in the queue
+    jobs.enqueue("send_verification_email", email=user.email, user_key=user.key)
     # Return the user data
     return user
 
@@ -75,16 +72,14 @@ def login(form_data: OAuth2PasswordRequestForm = Depends()):
 
 # Define an endpoint for requesting a password reset
 @router.post("/reset-password-request")
-def reset_password_request(background_tasks: BackgroundTasks, email: str):
+def reset_password_request(email: str):
      # Get the user from the database by email 
      user = crud.get_user_by_email(email) 
      # If the user is not found, return a success message anyway (to avoid leaking information) 
      if not user: 
          return {"message": "Password reset request sent"} 
-     # Generate a password reset token with the user key as the payload and a short expiration time 
-     token = create_access_token(user.key, expires_delta=timedelta(minutes=15)) 
-     # Send a password reset email to the user with the token as a link 
-     background_tasks.add_task(send_password_reset_email, user.email, token)
+     # Queue a password reset email to the user; the job generates a short-lived token, so it is not stored in the queue
+     jobs.enqueue("send_password_reset_email", email=user.email, user_key=user.key)
      # Return a success message 
      return {"message": "Password reset request sent"}
 
@@ -129,13 +124,48 @@ def delete_user(current_user: schemas.User = Depends(get_current_user)):
     user = crud.delete_user(current_user.key)
     return user
 
-# List users endpoint - Returns a list of all users in the system. Requires admin privileges.
-@router.get("/list", response_model=list[schemas.User])
-def list_users(current_user: schemas.User = Depends(get_current_user)):
+# List users endpoint - Returns a page of users, optionally filtered, without password hashes. Requires admin privileges.
+@router.get("/list", response_model=schemas.UserPage)
+def list_users(
+    request: Request,
+    current_user: schemas.User = Depends(get_current_user),
+    is_active: Optional[bool] = None,
+    is_admin: Optional[bool] = None,
+    username_prefix: Optional[str] = Query(None, min_length=1, max_length=50),
+    limit: int = Query(settings.user_page_size, gt=0, le=settings.user_page_max_size),
+    last: Optional[str] = Query(None, description="Cursor from the previous page"),
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is not admin")
+
+    def build():
+        users, next_last = crud.get_user_page(is_active, is_admin, username_prefix, limit, last)
+        return {"items": users, "last": next_last}
+
+    # Identical pages are served precompressed until a user changes
+    return compression.cached_json(request, "user", build)
+
+# Bulk activate endpoint - Activates or deactivates several users at once. Requires admin privileges.
+@router.put("/bulk-activate", response_model=schemas.UserBulkResult)
+def bulk_activate(bulk: schemas.UserBulkActivate, current_user: schemas.User = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is not admin")
+    if len(bulk.keys) > settings.batch_max_keys:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {settings.batch_max_keys} keys per request")
+    updated, missing = crud.set_users_active(bulk.keys, bulk.is_active)
+    return {"updated": updated, "missing": missing}
+
+# Batch users endpoint - Returns several users by key in one request. Requires admin privileges.
+@router.post("/batch", response_model=schemas.UserBatch)
+def get_users_batch(batch: schemas.BatchRequest, current_user: schemas.User = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is not admin")
-    users = crud.get_users()
-    return users
+    if len(batch.keys) > settings.batch_max_keys:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {settings.batch_max_keys} keys per request")
+    users = crud.get_users_by_keys(batch.keys)
+    # Return summaries, so password hashes never leave the server
+    summaries = [user and schemas.UserSummary(**user.dict(include=set(schemas.UserSummary.model_fields))) for user in users]
+    return {"items": [{"key": key, "user": summary} for key, summary in zip(batch.keys, summaries)]}
 
 # Promote user endpoint - Allows admins to promote a user to admin. Requires admin privileges.
 @router.put("/promote/{user_key}", response_model=schemas.User)
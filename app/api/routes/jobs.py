@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Depends, Query
+from db import schemas
+from core.security import get_current_admin_user
+from services import jobs
+
+router = APIRouter()
+
+# Get per-job metrics and queue depth. Requires admin privileges.
+@router.get("/stats")
+def get_stats(current_user: schemas.User = Depends(get_current_admin_user)):
+    return jobs.stats()
+
+# List dead-lettered jobs. Requires admin privileges.
+@router.get("/dead")
+def get_dead_jobs(
+    current_user: schemas.User = Depends(get_current_admin_user),
+    limit: int = Query(100, gt=0, le=1000),
+):
+    return jobs.queue.dead(limit)
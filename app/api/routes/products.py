@@ -1,10 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
+from fastapi.responses import JSONResponse
 from typing import List, Optional
-from db import crud, schemas
-from core.security import get_current_user
+from db import crud, schemas, snapshot
+from api import compression
+from core.config import settings
+from core.security import get_current_user, get_current_admin_user
 
 router = APIRouter()
 
+# Query parameter for returning only some fields of each product
+fields_query = Query(None, description="Comma-separated product fields to return, e.g. name,price")
+
+# Parse and check a fields parameter, returning None if all fields were asked for
+def parse_fields(fields: Optional[str]):
+    if not fields:
+        return None
+    fields = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in schemas.Product.model_fields]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
 # Create a new product
 @router.post("/create", response_model=schemas.Product)
 def create_product(product: schemas.ProductCreate):
@@ -13,31 +29,78 @@ def create_product(product: schemas.ProductCreate):
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
+# Export the catalog to the snapshot file new workers start from. Requires admin privileges.
+@router.post("/snapshot")
+def export_snapshot(current_user: schemas.User = Depends(get_current_admin_user)):
+    if not settings.catalog_snapshot_path:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Catalog snapshots are not configured")
+    try:
+        result = snapshot.export(settings.catalog_snapshot_path)
+        # Switch this worker over to the new snapshot
+        snapshot.load(settings.catalog_snapshot_path)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    return result
+
 # Get all products
 @router.get("/all", response_model=List[schemas.Product])
 def get_products(
+    request: Request,
     current_user: schemas.User = Depends(get_current_user),
     category: Optional[str] = Query(None, min_length=1, max_length=50),
     min_price: Optional[float] = Query(None, gt=0),
     max_price: Optional[float] = Query(None, gt=0),
+    fields: Optional[str] = fields_query,
 ):
+    fields = parse_fields(fields)
+
+    def build():
+        try:
+            products = crud.get_products(category, min_price, max_price, fields)
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        if not products:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No products found")
+        # Sparse products are already plain dictionaries; full ones are trimmed to the response schema
+        if fields:
+            return products
+        return [product.dict(include=set(schemas.Product.model_fields)) for product in products]
+
+    # Identical listings are served precompressed until the catalog changes
+    return compression.cached_json(request, "product", build)
+
+# Get several products by key in one request
+@router.post("/batch", response_model=schemas.ProductBatch)
+def get_products_batch(batch: schemas.BatchRequest, fields: Optional[str] = fields_query):
+    if len(batch.keys) > settings.batch_max_keys:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {settings.batch_max_keys} keys per request")
+    fields = parse_fields(fields)
     try:
-        products = crud.get_products(category, min_price, max_price)
+        products = crud.get_products_by_keys(batch.keys, fields)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    if not products:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No products found")
-    return products
+    items = [{"key": key, "product": product} for key, product in zip(batch.keys, products)]
+    if fields:
+        return JSONResponse(content={"items": items})
+    return {"items": items}
+
+# Get product cache statistics for tuning. Requires admin privileges.
+@router.get("/cache-stats")
+def get_cache_stats(current_user: schemas.User = Depends(get_current_admin_user)):
+    return crud.product_cache.stats()
 
 # Get a product by key
 @router.get("/{key}", response_model=schemas.Product)
-def get_product(key: str):
+def get_product(key: str, fields: Optional[str] = fields_query):
+    fields = parse_fields(fields)
     try:
-        product = crud.get_product(key)
+        product = crud.get_product(key, fields)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     if not product:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    if fields:
+        return JSONResponse(content=product)
     return product
 
 # Update a product by key
@@ -45,6 +108,8 @@ def get_product(key: str):
 def update_product(key: str, product: schemas.ProductUpdate):
     try:
         product = crud.update_product(key, product)
+    except crud.VersionConflictError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     if not product:
@@ -62,4 +127,94 @@ def delete_product(key: str):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
     return product
 
+# Get the available stock of a product
+@router.get("/{key}/stock", response_model=schemas.Stock)
+def get_stock(key: str):
+    try:
+        stock = crud.get_stock(key)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    if stock is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    return {"product_key": key, "stock": stock}
+
+# Restock or write off units of a product. Requires admin privileges.
+@router.post("/{key}/adjust-stock", response_model=schemas.Stock)
+def adjust_stock(
+    key: str,
+    adjustment: schemas.StockAdjust,
+    current_user: schemas.User = Depends(get_current_admin_user),
+):
+    try:
+        stock = crud.adjust_stock(key, adjustment.delta)
+    except crud.OutOfStockError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    if stock is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    return {"product_key": key, "stock": stock}
+
+# Reserve stock of a product for the current user
+@router.post("/{key}/reserve", response_model=schemas.Reservation)
+def reserve_stock(
+    key: str,
+    reservation: schemas.ReservationCreate,
+    current_user: schemas.User = Depends(get_current_user),
+):
+    if reservation.quantity < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Quantity must be at least 1")
+    try:
+        reservation = crud.reserve_stock(key, current_user.key, reservation.quantity)
+    except crud.OutOfStockError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    if not reservation:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    return reservation
 
+# Release a reservation of the current user, returning its units to stock
+@router.delete("/reservations/{key}", response_model=schemas.Reservation)
+def release_reservation(key: str, current_user: schemas.User = Depends(get_current_user)):
+    reservation = crud.get_reservation(key)
+    if not reservation or reservation.user_key != current_user.key:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
+    try:
+        reservation = crud.release_reservation(key)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    if not reservation:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
+    return reservation
+
+# Commit a reservation of the current user once the sale goes through, keeping its units out of stock
+@router.post("/reservations/{key}/commit", response_model=schemas.Reservation)
+def commit_reservation(key: str, current_user: schemas.User = Depends(get_current_user)):
+    reservation = crud.get_reservation(key)
+    if not reservation or reservation.user_key != current_user.key:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Reservation not found")
+    try:
+        reservation = crud.commit_reservation(key)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    if not reservation:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Reservation has expired or was already released")
+    return reservation
+
+# Spread the stock of a hot product across shard counters. Requires admin privileges.
+@router.post("/{key}/shard-stock", response_model=schemas.Product)
+def shard_stock(
+    key: str,
+    shards: int = Query(8, ge=2, le=64),
+    current_user: schemas.User = Depends(get_current_admin_user),
+):
+    try:
+        product = crud.shard_stock(key, shards)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    if not product:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    return product
@@ -30,6 +30,72 @@ class Settings(BaseSettings):
     email_port: int = os.getenv("APP_EMAIL_PORT")
     # deta app key
     deta_app_key: str = os.getenv("DETA_APP_KEY")
+    # use the in-process Deta Base emulator instead of hosted Deta, for tests and benchmarks
+    deta_emulator: bool = os.getenv("APP_DETA_EMULATOR", False)
+    # latency added to every emulated round trip, plus a random jitter of up to emulator_jitter_ms
+    emulator_latency_ms: float = os.getenv("APP_EMULATOR_LATENCY_MS", 0.0)
+    emulator_jitter_ms: float = os.getenv("APP_EMULATOR_JITTER_MS", 0.0)
+    # fraction of emulated round trips that fail
+    emulator_failure_rate: float = os.getenv("APP_EMULATOR_FAILURE_RATE", 0.0)
+    # seed for the emulator's latency and failure draws, so runs are repeatable
+    emulator_seed: int = os.getenv("APP_EMULATOR_SEED", 0)
+    # path of the sqlite file backing the job queue
+    jobs_db_path: str = os.getenv("APP_JOBS_DB_PATH", "jobs.sqlite3")
+    # number of concurrent job workers
+    jobs_workers: int = os.getenv("APP_JOBS_WORKERS", 4)
+    # number of attempts before a job is moved to the dead letter state
+    jobs_max_attempts: int = os.getenv("APP_JOBS_MAX_ATTEMPTS", 5)
+    # delay in seconds before the first retry, doubled on each further attempt
+    jobs_retry_delay: float = os.getenv("APP_JOBS_RETRY_DELAY", 5.0)
+    # seconds a worker holds a claimed job; a job still running after this is failed, and the job of a dead worker is claimed again
+    jobs_lease_seconds: float = os.getenv("APP_JOBS_LEASE_SECONDS", 300.0)
+    # seconds an idle worker waits before checking for delayed jobs
+    jobs_poll_interval: float = os.getenv("APP_JOBS_POLL_INTERVAL", 1.0)
+    # seconds a stock reservation holds units before they return to stock
+    reservation_ttl_seconds: int = os.getenv("APP_RESERVATION_TTL_SECONDS", 900)
+    # seconds between sweeps that release expired reservations
+    reservation_sweep_interval: float = os.getenv("APP_RESERVATION_SWEEP_INTERVAL", 60.0)
+    # how workers tell each other about changed records: "local" for a single worker or "unix" for several
+    invalidation_broker: str = os.getenv("APP_INVALIDATION_BROKER", "local")
+    # directory holding one invalidation socket per worker for the "unix" broker
+    invalidation_socket_dir: str = os.getenv("APP_INVALIDATION_SOCKET_DIR", "/tmp/ecommerce-invalidation")
+    # seconds a cached user stays valid. Users decide authentication and admin rights, and invalidation
+    # events are best effort (and do not leave the process with the "local" broker), so keep this short
+    user_cache_ttl_seconds: float = os.getenv("APP_USER_CACHE_TTL_SECONDS", 5.0)
+    # path of the catalog snapshot workers map at startup; empty to always read the catalog from storage
+    catalog_snapshot_path: str = os.getenv("APP_CATALOG_SNAPSHOT_PATH", "")
+    # seconds between reads of the snapshot's delta log for changes made by other workers, bounding how long
+    # a change goes unseen when its invalidation event is lost
+    catalog_delta_poll_seconds: float = os.getenv("APP_CATALOG_DELTA_POLL_SECONDS", 5.0)
+    # size in bytes past which the delta log is compacted to the latest change of each product
+    catalog_delta_max_bytes: int = os.getenv("APP_CATALOG_DELTA_MAX_BYTES", 1048576)
+    # maximum number of keys in one batch request
+    batch_max_keys: int = os.getenv("APP_BATCH_MAX_KEYS", 100)
+    # number of storage reads a batch request runs concurrently
+    batch_concurrency: int = os.getenv("APP_BATCH_CONCURRENCY", 16)
+    # responses smaller than this many bytes are sent uncompressed
+    compression_min_size: int = os.getenv("APP_COMPRESSION_MIN_SIZE", 1024)
+    # gzip compression level, 1 (fastest) to 9 (smallest)
+    gzip_level: int = os.getenv("APP_GZIP_LEVEL", 6)
+    # brotli quality, 0 (fastest) to 11 (smallest); brotli is used only if installed
+    brotli_quality: int = os.getenv("APP_BROTLI_QUALITY", 5)
+    # number of precompressed listings kept per worker
+    response_cache_size: int = os.getenv("APP_RESPONSE_CACHE_SIZE", 128)
+    # seconds a precompressed listing is served; bounds staleness of stock, which moves without invalidation events
+    # (with a snapshot, stock changes are picked up from its delta log every catalog_delta_poll_seconds)
+    response_cache_ttl_seconds: float = os.getenv("APP_RESPONSE_CACHE_TTL_SECONDS", 30.0)
+    # default and maximum page size of user listings
+    user_page_size: int = os.getenv("APP_USER_PAGE_SIZE", 50)
+    user_page_max_size: int = os.getenv("APP_USER_PAGE_MAX_SIZE", 500)
+    # maximum number of products cached per worker
+    product_cache_size: int = os.getenv("APP_PRODUCT_CACHE_SIZE", 10000)
+    # seconds a cached product is fresh; writes are invalidated across workers, but stock moves without events
+    # (with a snapshot, stock changes are picked up from its delta log every catalog_delta_poll_seconds)
+    product_cache_ttl_seconds: float = os.getenv("APP_PRODUCT_CACHE_TTL_SECONDS", 60.0)
+    # seconds after that a cached product is still served while it is refreshed in the background
+    product_cache_stale_seconds: float = os.getenv("APP_PRODUCT_CACHE_STALE_SECONDS", 300.0)
+    # seconds to remember that a product key does not exist
+    product_cache_negative_ttl_seconds: float = os.getenv("APP_PRODUCT_CACHE_NEGATIVE_TTL_SECONDS", 10.0)
 
 # Create a settings instance
 settings = Settings()
@@ -1,11 +1,21 @@
 # base.py
-from deta import Deta
 from pydantic import BaseModel
+from typing import Optional
 from core.config import settings
 
 
-# Initialize Deta with your project key
-deta = Deta(settings.deta_app_key)
+# Initialize Deta with your project key, or the local emulator when testing and benchmarking
+if settings.deta_emulator:
+    from .emulator import Deta
+    deta = Deta(
+        latency=settings.emulator_latency_ms / 1000,
+        jitter=settings.emulator_jitter_ms / 1000,
+        failure_rate=settings.emulator_failure_rate,
+        seed=settings.emulator_seed,
+    )
+else:
+    from deta import Deta
+    deta = Deta(settings.deta_app_key)
 
 # Create a Deta Base instance for categories
 categories_db = deta.Base("ecommerce_categories")
@@ -24,6 +34,9 @@ class Category(BaseModel):
 # Create a Deta Base instance for products
 products_db = deta.Base("ecommerce_products")
 
+# Create a Deta Base instance for product version claims; inserting one is the compare-and-set for an update
+product_versions_db = deta.Base("ecommerce_product_versions")
+
 # Define a Pydantic model for the Product entity
 class Product(BaseModel):
     # Use key as the primary identifier
@@ -33,10 +46,50 @@ class Product(BaseModel):
     price: float
     image: str
     category: Category  # new field
+    # Units available for sale; only changed through atomic increments. Read as None for sharded products,
+    # whose stock is held in their shards
+    stock: Optional[int] = 0
+    # Number of stock shards for hot products, or 0 if stock is held on the product itself
+    stock_shards: int = 0
+    # Incremented on every write, used for optimistic concurrency
+    version: int = 0
+
+    # Define a string representation of the model
+    def __repr__(self):
+        return f"<Product(key={self.key}, name={self.name}, description={self.description}, price={self.price}, image={self.image}, category={self.category}, stock={self.stock}, version={self.version})>"
+
+# Create a Deta Base instance for stock shards of hot products
+stock_shards_db = deta.Base("ecommerce_stock_shards")
+
+# Define a Pydantic model for a StockShard entity
+class StockShard(BaseModel):
+    # Use key as the primary identifier (composed of product_key and shard index)
+    key: str
+    product_key: str
+    stock: int
+
+    # Define a string representation of the model
+    def __repr__(self):
+        return f"<StockShard(key={self.key}, product_key={self.product_key}, stock={self.stock})>"
+
+# Create a Deta Base instance for stock reservations
+reservations_db = deta.Base("ecommerce_reservations")
+
+# Define a Pydantic model for the Reservation entity
+class Reservation(BaseModel):
+    # Use key as the primary identifier
+    key: str
+    product_key: str
+    user_key: str
+    quantity: int
+    # Units taken from each shard by shard key, if the product is sharded
+    shards: Optional[dict] = None
+    # Unix timestamp after which unclaimed units return to stock
+    expires_at: float
 
     # Define a string representation of the model
     def __repr__(self):
-        return f"<Product(key={self.key}, name={self.name}, description={self.description}, price={self.price}, image={self.image}, category={self.category})>"
+        return f"<Reservation(key={self.key}, product_key={self.product_key}, user_key={self.user_key}, quantity={self.quantity}, shards={self.shards}, expires_at={self.expires_at})>"
 
 # Create a Deta Base instance for users
 users_db = deta.Base("ecommerce_users")
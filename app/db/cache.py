@@ -0,0 +1,104 @@
+# cache.py
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+
+# Define a bounded LRU cache with TTLs, single-flight loading, stale-while-revalidate and negative entries
+class Cache:
+    def __init__(self, max_size: int, ttl: float, stale_ttl: float, negative_ttl: float, executor):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Seconds after expiry during which the old value is still served while it is refreshed
+        self.stale_ttl = stale_ttl
+        # Seconds to remember that a key does not exist
+        self.negative_ttl = negative_ttl
+        # Executor for background refreshes of stale entries
+        self.executor = executor
+        # Entries by key as (value, fresh_until, stale_until)
+        self.entries = OrderedDict()
+        # Loads in flight by key, shared by every caller that misses on the key meanwhile
+        self.loading = {}
+        # Keys written or invalidated while they were loading, so the load does not overwrite them when it finishes.
+        # There is at most one load per key, and a key is dropped from here when its load finishes.
+        self.superseded = set()
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    # Store an entry and evict the least recently used ones beyond the size bound; call with the lock held
+    def _store(self, key, value):
+        now = time.time()
+        if value is None:
+            self.entries[key] = (None, now + self.negative_ttl, now + self.negative_ttl)
+        else:
+            self.entries[key] = (value, now + self.ttl, now + self.ttl + self.stale_ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.counts["evictions"] += 1
+
+    # Load a key and store the result unless the key was written meanwhile; resolves the shared future
+    def _load(self, key, loader, future: Future):
+        try:
+            value = loader(key)
+        except Exception as e:
+            with self.lock:
+                self.loading.pop(key, None)
+                self.superseded.discard(key)
+            future.set_exception(e)
+            return
+        with self.lock:
+            if key not in self.superseded:
+                self._store(key, value)
+            self.loading.pop(key, None)
+            self.superseded.discard(key)
+        future.set_result(value)
+
+    # Get a key, loading it with loader(key) on a miss; loader returns None for keys that do not exist
+    def get(self, key, loader):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now < entry[2]:
+                self.entries.move_to_end(key)
+                value, fresh_until, _ = entry
+                if now < fresh_until:
+                    self.counts["negative_hits" if value is None else "hits"] += 1
+                    return value
+                # Serve the stale value and refresh it in the background, once
+                self.counts["stale_hits"] += 1
+                if key not in self.loading:
+                    future = self.loading[key] = Future()
+                    self.counts["refreshes"] += 1
+                    self.executor.submit(self._load, key, loader, future)
+                return value
+            future = self.loading.get(key)
+            if future is not None:
+                self.counts["coalesced"] += 1
+                owner = False
+            else:
+                future = self.loading[key] = Future()
+                self.counts["misses"] += 1
+                owner = True
+        if owner:
+            self._load(key, loader, future)
+        return future.result()
+
+    # Write a value through to the cache; None records that the key does not exist
+    def set(self, key, value):
+        with self.lock:
+            if key in self.loading:
+                self.superseded.add(key)
+            self._store(key, value)
+
+    # Drop a key, so the next get loads it again
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.loading:
+                self.superseded.add(key)
+            self.entries.pop(key, None)
+
+    # Get the hit, miss and eviction counts and the current size, for tuning
+    def stats(self):
+        with self.lock:
+            return {**self.counts, "size": len(self.entries), "max_size": self.max_size}
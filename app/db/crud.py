@@ -1,10 +1,62 @@
 # crud.py
-from . import base, schemas
+from . import base, cache, invalidation, schemas, snapshot
 from uuid import uuid4
 from typing import Optional
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from core.config import settings
 
 
+# Raised when an update was made against a stale version of a record
+class VersionConflictError(Exception):
+    pass
 
+# Raised when a product does not have enough stock for a reservation
+class OutOfStockError(Exception):
+    pass
+
+# Cache of users by key as (expires_at, user), kept correct across workers by invalidation events
+_user_cache = {}
+# Bumped on every user invalidation so a read that raced with a write is not cached
+_user_generation = 0
+
+# Thread pool for running the storage reads of a batch request concurrently, since Deta has no multi-get
+_batch_pool = ThreadPoolExecutor(settings.batch_concurrency, thread_name_prefix="batch")
+
+# Get several records at once with a getter, reading each distinct key once; returns {key: record or None}
+def _get_many(getter, keys: list):
+    keys = list(dict.fromkeys(keys))
+    return dict(zip(keys, _batch_pool.map(getter, keys)))
+
+# Cache of product records by key, written through by this worker and invalidated by the others
+product_cache = cache.Cache(
+    settings.product_cache_size,
+    settings.product_cache_ttl_seconds,
+    settings.product_cache_stale_seconds,
+    settings.product_cache_negative_ttl_seconds,
+    # Refreshes get their own threads, so batch reads waiting on a refresh cannot starve it
+    ThreadPoolExecutor(2, thread_name_prefix="product-cache"),
+)
+
+# Drop a product changed by another worker from the cache
+@invalidation.subscribe("product")
+def _invalidate_product(key: str):
+    product_cache.invalidate(key)
+
+# Tell every worker that a product changed and record it for workers started from an older snapshot,
+# then write the new record (or None if it was deleted) through to this worker's cache
+def _product_changed(key: str, product: Optional[dict]):
+    snapshot.log_change(key)
+    invalidation.publish("product", key)
+    product_cache.set(key, product)
+
+# Drop a changed user from the cache
+@invalidation.subscribe("user")
+def _invalidate_user(key: str):
+    global _user_generation
+    _user_generation += 1
+    _user_cache.pop(key, None)
 
 # Update the create_product function to include a category field
 def create_product(product: schemas.ProductCreate):
@@ -19,13 +71,32 @@ def create_product(product: schemas.ProductCreate):
         description=product.description,
         price=product.price,
         image=product.image,
-        category=category_  # new field
+        category=category_,  # new field
+        stock=product.stock,
     )
     base.products_db.put(product.dict())
     base.categories_db.put(category_.dict())
+    _product_changed(key, product.dict())
+    return product
+
+# Clear the stock on the record of a sharded product, which is not its stock; that lives in the shards and
+# is summed by get_stock
+def _hide_sharded_stock(product: dict):
+    if product.get("stock_shards"):
+        product = {**product, "stock": None}
     return product
 
-def get_products(category: Optional[str] = None, min_price: Optional[float] = None, max_price: Optional[float] = None):
+# Keep only the given fields of a product record
+def _project(product: dict, fields: list):
+    return {field: product[field] for field in fields if field in product}
+
+# Get the products matching the filters; with fields, return dictionaries holding only those fields (plus the key)
+def get_products(category: Optional[str] = None, min_price: Optional[float] = None, max_price: Optional[float] = None, fields: Optional[list] = None):
+    read_fields = fields
+    if fields:
+        fields = list(dict.fromkeys(["key", *fields]))
+        # Whether stock is real depends on whether the product is sharded
+        read_fields = fields + ["stock_shards"] if "stock" in fields else fields
     query = {}
     if category:
         query["category.name?contains"] = category
@@ -33,34 +104,90 @@ def get_products(category: Optional[str] = None, min_price: Optional[float] = No
         query["price?gte"] = min_price
     if max_price is not None:
         query["price?lte"] = max_price
-    products = base.products_db.fetch(query).items
-    products = [base.Product(**product) for product in products]
+    # Serve the listing from the mapped catalog snapshot when there is one
+    if snapshot.loaded():
+        products = snapshot.get_products(category, min_price, max_price, read_fields)
+    else:
+        products = base.products_db.fetch(query).items
+    if fields:
+        # Deta has no projection, so drop the other fields before building any models
+        return [_project(_hide_sharded_stock(product), fields) for product in products]
+    products = [base.Product(**_hide_sharded_stock(product)) for product in products]
     return products
 
-# Get a product by key from the database 
-def get_product(key: str): 
-    # Get the product from the database by key as a dictionary or None if not found 
-    product = base.products_db.get(key) 
-    # If the product is found, convert it to a Product instance 
-    if product: 
-        product = base.Product(**product) 
-    # Return the product or None 
+# Load a product record from the catalog snapshot, falling back to the database, or None if not found
+def _load_product(key: str):
+    product = snapshot.get_product(key) if snapshot.loaded() else None
+    if product is None:
+        product = base.products_db.get(key)
     return product
 
-# Update a product by key in the database
-def update_product(key: str, product: schemas.ProductUpdate):
-    # Get the product from the database by key as a dictionary or None if not found
+# Get a product by key through the product cache; with fields, return a dictionary holding only those fields (plus the key)
+def get_product(key: str, fields: Optional[list] = None): 
+    product = product_cache.get(key, _load_product)
+    if product is None:
+        return None
+    product = _hide_sharded_stock(product)
+    if fields:
+        return _project(product, ["key", *fields])
+    # Convert the record to a Product instance 
+    return base.Product(**product)
+
+# Get several products by key, returned in the order of the keys with None for keys that were not found
+def get_products_by_keys(keys: list, fields: Optional[list] = None):
+    products = _get_many(lambda key: get_product(key, fields), keys)
+    return [products[key] for key in keys]
+
+# Claim the right to write a version of a product. Deta has no conditional writes, but insert fails if the key
+# exists, so exactly one writer wins each version. Claims expire once no writer can still be racing for them,
+# which is only as long as it takes to read a product and claim its next version.
+def _claim_product_version(key: str, version: int):
+    try:
+        base.product_versions_db.insert({"product_key": key}, f"{key}_v{version}", expire_in=10)
+    except Exception:
+        return False
+    return True
+
+# Update a product by key in the database, writing only the fields that were set
+def update_product(key: str, product_update: schemas.ProductUpdate):
+    updates = product_update.dict(exclude_unset=True, exclude_none=True)
+    # The expected version is a precondition, not a field to write
+    expected_version = updates.pop("version", None)
+    for attempt in range(5):
+        current = base.products_db.get(key)
+        # If the product is not found, return None
+        if current is None:
+            return None
+        version = current.get("version", 0)
+        if expected_version is not None and version != expected_version:
+            raise VersionConflictError(f"Product {key} is at version {version}, not {expected_version}")
+        if _claim_product_version(key, version + 1):
+            break
+        # Another writer claimed the next version first
+        if expected_version is not None:
+            raise VersionConflictError(f"Product {key} was modified concurrently")
+        time.sleep(0.05 * (attempt + 1))
+    else:
+        raise VersionConflictError(f"Product {key} is being modified too often, try again")
+    updates["version"] = version + 1
+    try:
+        base.products_db.update(updates, key)
+    except Exception:
+        # The version was not written, so give up the claim rather than lock out other writers until it expires
+        base.product_versions_db.delete(f"{key}_v{version + 1}")
+        # Deta raises when the key does not exist
+        if base.products_db.get(key) is None:
+            return None
+        raise
+    if "category" in updates:
+        base.categories_db.put(updates["category"])
+    # The write has landed, so tell the other workers and the caches whatever happens next
     product = base.products_db.get(key)
-    # If the product is not found, return None
+    _product_changed(key, product)
     if product is None:
         return None
-    # Update the product attributes with the schema data
-    for key, value in product.dict().items():
-        setattr(product, key, value)
-    # Put the updated product in the database
-    base.products_db.put(product.dict())
     # Return the updated product
-    return product
+    return base.Product(**_hide_sharded_stock(product))
 
 # Delete a product by key from the database
 def delete_product(key: str):
@@ -71,6 +198,7 @@ def delete_product(key: str):
         return None
     # Delete the product from the database by key
     base.products_db.delete(key)
+    _product_changed(key, None)
     # Return the deleted product as a Product instance
     return base.Product(**product)
 
@@ -89,6 +217,8 @@ def create_user(user: schemas.UserCreate):
     )
     # Put the user in the database
     base.users_db.put(user.dict())
+    # Tell every worker, so cached user listings include the new user
+    invalidation.publish("user", key)
     # Return the user
     return user
 
@@ -103,16 +233,44 @@ def get_users():
      # Return the users 
      return users
 
-# Get a user by key from the database 
+# Get a page of users matching the filters, without their password hashes; returns (users, last key or None)
+def get_user_page(is_active: Optional[bool] = None, is_admin: Optional[bool] = None, username_prefix: Optional[str] = None,
+                  limit: int = 50, last: Optional[str] = None):
+    # Filter in the database rather than fetching every user
+    query = {}
+    if is_active is not None:
+        query["is_active"] = is_active
+    if is_admin is not None:
+        query["is_admin"] = is_admin
+    if username_prefix:
+        query["username?pfx"] = username_prefix
+    res = base.users_db.fetch(query or None, limit=limit, last=last)
+    # Deta cannot project, so drop the hashes before building any models
+    users = [schemas.UserSummary(**{field: user[field] for field in schemas.UserSummary.model_fields}) for user in res.items]
+    return users, res.last
+
+# Get a user by key from the cache, or from the database if it is not cached
 def get_user(key: str): 
+     cached = _user_cache.get(key)
+     if cached and cached[0] > time.time():
+         return cached[1].copy()
+     generation = _user_generation
      # Get the user from the database by key as a dictionary or None if not found 
      user = base.users_db.get(key) 
      # If the user is found, convert it to a User instance 
      if user: 
          user = base.User(**user) 
+         # Only cache the user if it was not changed while it was being read
+         if generation == _user_generation:
+             _user_cache[key] = (time.time() + settings.user_cache_ttl_seconds, user.copy())
      # Return the user or None 
      return user
 
+# Get several users by key, returned in the order of the keys with None for keys that were not found
+def get_users_by_keys(keys: list):
+    users = _get_many(get_user, keys)
+    return [users[key] for key in keys]
+
 # Get a user by username from the database 
 def get_user_by_username(username: str): 
      # Fetch all users from the database that match the username as a list of dictionaries (or empty list if not found) 
@@ -155,13 +313,33 @@ def update_user(key: str, user_update: schemas.UserUpdate):
     # Create a User object from the dictionary
     user = base.User(**user_dict)
     # Update the user attributes with the schema data
-    for key, value in user_update.dict(exclude_unset=True).items():
-        setattr(user, key, value)
+    for field, value in user_update.dict(exclude_unset=True).items():
+        setattr(user, field, value)
     # Put the updated user in the database
     base.users_db.put(user.dict())
+    invalidation.publish("user", key)
     # Return the updated user
     return user
 
+# Set is_active on several users at once; returns (updated keys, missing keys)
+def set_users_active(keys: list, is_active: bool):
+    keys = list(dict.fromkeys(keys))
+
+    # Partial updates run concurrently, so a bulk change cannot clobber other fields written meanwhile
+    def update(key: str):
+        try:
+            base.users_db.update({"is_active": is_active}, key)
+        except Exception:
+            # Deta raises when the key does not exist
+            if base.users_db.get(key) is None:
+                return False
+            raise
+        invalidation.publish("user", key)
+        return True
+
+    results = dict(zip(keys, _batch_pool.map(update, keys)))
+    return [key for key in keys if results[key]], [key for key in keys if not results[key]]
+
 # Delete a user by key from the database
 def delete_user(key: str):
     # Get the user from the database by key as a dictionary or None if not found
@@ -171,5 +349,220 @@ def delete_user(key: str):
         return None
     # Delete the user from the database by key
     base.users_db.delete(key)
+    invalidation.publish("user", key)
     # Return the deleted user as a User instance
-    return base.User(**user)
\ No newline at end of file
+    return base.User(**user)
+
+# Atomically add delta to a counter record and return the new value, or None if the record does not exist
+def _increment(db, key: str, field: str, delta: int):
+    try:
+        db.update({field: db.util.increment(delta)}, key)
+    except Exception:
+        # Deta raises when the key does not exist
+        if db.get(key) is None:
+            return None
+        raise
+    return db.get(key)[field]
+
+# Atomically take quantity units from a counter, undoing the decrement if it overdrew the counter.
+# A concurrent taker's decrement (or its undo) can make the counter look short for a moment, so the take is
+# retried while the counter still reads as holding enough once ours is undone.
+def _take(db, key: str, field: str, quantity: int):
+    for attempt in range(5):
+        remaining = _increment(db, key, field, -quantity)
+        if remaining is None:
+            return False
+        if remaining >= 0:
+            return True
+        # Put the units back; stock is never oversold
+        restored = _increment(db, key, field, quantity)
+        if restored is None or restored < quantity:
+            return False
+        # Step out of lockstep with the other takers before trying again
+        time.sleep(random.uniform(0, 0.01 * (attempt + 1)))
+    return False
+
+# Get the available stock of a product, summing its shards if it is sharded
+def get_stock(key: str):
+    product = base.products_db.get(key)
+    if product is None:
+        return None
+    if not product.get("stock_shards"):
+        return product.get("stock", 0)
+    shards = base.stock_shards_db.fetch({"product_key": key}).items
+    return sum(shard["stock"] for shard in shards)
+
+# Take units from the shards of a product, returning {shard key: units taken}. A reservation can span shards,
+# so it succeeds whenever the shards hold enough between them.
+def _take_from_shards(product_key: str, shards: int, quantity: int):
+    start = random.randrange(shards)
+    # Most reservations fit in the first shard tried, which costs no more round trips than an unsharded take
+    shard_key = f"{product_key}_shard_{start}"
+    if _take(base.stock_shards_db, shard_key, "stock", quantity):
+        return {shard_key: quantity}
+    taken = {}
+    needed = quantity
+    # Otherwise take what each shard holds, making a few passes in case units are being put back meanwhile
+    for _ in range(3):
+        for i in range(shards):
+            if not needed:
+                return taken
+            shard_key = f"{product_key}_shard_{(start + i) % shards}"
+            shard = base.stock_shards_db.get(shard_key)
+            amount = min(shard["stock"] if shard else 0, needed)
+            if amount > 0 and _take(base.stock_shards_db, shard_key, "stock", amount):
+                taken[shard_key] = taken.get(shard_key, 0) + amount
+                needed -= amount
+        if not needed:
+            return taken
+    # The shards do not hold enough between them; give back what was taken
+    for shard_key, amount in taken.items():
+        _increment(base.stock_shards_db, shard_key, "stock", amount)
+    raise OutOfStockError(f"Not enough stock for product {product_key}")
+
+# Record a change to the stock held on a product record. Stock changes on every reservation, so it is not
+# published as an event, which would drop every cached listing each time. Workers pick it up from the delta log
+# at their next poll, or when their cached copy expires. Sharded stock lives in the shard records, which are
+# always read from storage.
+def _stock_changed(key: str):
+    snapshot.log_change(key)
+
+# Take units from a product, returning {shard key: units taken} if it is sharded, or None if not
+def _take_stock(product: dict, quantity: int):
+    shards = product.get("stock_shards", 0)
+    if shards:
+        return _take_from_shards(product["key"], shards, quantity)
+    if not _take(base.products_db, product["key"], "stock", quantity):
+        raise OutOfStockError(f"Not enough stock for product {product['key']}")
+    _stock_changed(product["key"])
+    return None
+
+# Spread units evenly over the shards of a product, starting from a random shard
+def _add_to_shards(key: str, shards: int, quantity: int):
+    start = random.randrange(shards)
+    for n in range(shards):
+        share = quantity // shards + (1 if n < quantity % shards else 0)
+        if share:
+            _increment(base.stock_shards_db, f"{key}_shard_{(start + n) % shards}", "stock", share)
+
+# Move the stock left on the record of a sharded product to its shards; loop because in-flight reservations
+# made before it was sharded may still put units back on the record
+def _move_stock_to_shards(key: str, shards: int):
+    while True:
+        stock = (base.products_db.get(key) or {}).get("stock", 0)
+        if stock <= 0:
+            break
+        if _take(base.products_db, key, "stock", stock):
+            _add_to_shards(key, shards, stock)
+
+# Add units to a product's stock, or remove them with a negative delta, and return the new total.
+# Stock is only ever moved by increments, so this never races with reservations.
+def adjust_stock(key: str, delta: int):
+    product = base.products_db.get(key)
+    if product is None:
+        return None
+    shards = product.get("stock_shards", 0)
+    if delta < 0:
+        _take_stock(product, -delta)
+    elif delta > 0 and shards:
+        _add_to_shards(key, shards, delta)
+    elif delta > 0:
+        _increment(base.products_db, key, "stock", delta)
+        _stock_changed(key)
+    return get_stock(key)
+
+# Spread the stock of a hot product across several shard counters to reduce write contention
+def shard_stock(key: str, shards: int):
+    product = base.products_db.get(key)
+    if product is None:
+        return None
+    if product.get("stock_shards"):
+        raise ValueError(f"Product {key} is already sharded")
+    # Create empty shards, then route new reservations to them; Deta puts at most 25 items per call
+    empty_shards = [base.StockShard(key=f"{key}_shard_{i}", product_key=key, stock=0).dict() for i in range(shards)]
+    for i in range(0, shards, 25):
+        base.stock_shards_db.put_many(empty_shards[i:i + 25])
+    base.products_db.update({"stock_shards": shards}, key)
+    _move_stock_to_shards(key, shards)
+    product = base.products_db.get(key)
+    _product_changed(key, product)
+    return base.Product(**_hide_sharded_stock(product))
+
+# Reserve units of a product for a user until the reservation expires
+def reserve_stock(product_key: str, user_key: str, quantity: int):
+    product = base.products_db.get(product_key)
+    if product is None:
+        return None
+    shards = _take_stock(product, quantity)
+    reservation = base.Reservation(
+        key=f"reservation_{uuid4().hex}",
+        product_key=product_key,
+        user_key=user_key,
+        quantity=quantity,
+        shards=shards,
+        expires_at=time.time() + settings.reservation_ttl_seconds,
+    )
+    base.reservations_db.put(reservation.dict())
+    return reservation
+
+# Get a reservation by key from the database
+def get_reservation(key: str):
+    reservation = base.reservations_db.get(key)
+    if reservation:
+        reservation = base.Reservation(**reservation)
+    return reservation
+
+# Claim a reservation exactly once, so a release and a commit (or two sweeps) cannot both act on it
+def _claim_reservation(key: str):
+    try:
+        # Deta insert fails if the key already exists; the marker expires once the reservation is long gone
+        base.reservations_db.insert({"claimed": True}, f"claim_{key}", expire_in=24 * 60 * 60)
+    except Exception:
+        return False
+    return True
+
+# Return the units of a reservation to stock
+def release_reservation(key: str):
+    reservation = base.reservations_db.get(key)
+    if reservation is None or not _claim_reservation(key):
+        return None
+    reservation = base.Reservation(**reservation)
+    if reservation.shards:
+        for shard_key, amount in reservation.shards.items():
+            _increment(base.stock_shards_db, shard_key, "stock", amount)
+    else:
+        product = base.products_db.get(reservation.product_key) or {}
+        shards = product.get("stock_shards", 0)
+        if shards:
+            # Reserved before the product was sharded; the record's stock is no longer read, so use the shards
+            _add_to_shards(reservation.product_key, shards, reservation.quantity)
+        else:
+            _increment(base.products_db, reservation.product_key, "stock", reservation.quantity)
+            # The product may have been sharded since it was read, after its stock was moved
+            product = base.products_db.get(reservation.product_key) or {}
+            if product.get("stock_shards"):
+                _move_stock_to_shards(reservation.product_key, product["stock_shards"])
+            _stock_changed(reservation.product_key)
+    base.reservations_db.delete(key)
+    return reservation
+
+# Turn a reservation into a sale, keeping its units out of stock
+def commit_reservation(key: str):
+    reservation = base.reservations_db.get(key)
+    if reservation is None or reservation["expires_at"] < time.time() or not _claim_reservation(key):
+        return None
+    base.reservations_db.delete(key)
+    return base.Reservation(**reservation)
+
+# Release every reservation that has expired and return how many were released
+def release_expired_reservations():
+    released = 0
+    res = base.reservations_db.fetch({"expires_at?lt": time.time()})
+    while True:
+        for reservation in res.items:
+            if release_reservation(reservation["key"]):
+                released += 1
+        if not res.last:
+            break
+        res = base.reservations_db.fetch({"expires_at?lt": time.time()}, last=res.last)
+    return released
@@ -0,0 +1,258 @@
+# emulator.py
+#
+# An in-process stand-in for Deta Base, with the same interface as the deta SDK's Deta and Base classes.
+# Latency and failures are injected from a seeded random generator, so runs are repeatable:
+#
+#   APP_DETA_EMULATOR=1 APP_EMULATOR_LATENCY_MS=20 APP_EMULATOR_FAILURE_RATE=0.01 uvicorn main:app
+import copy
+import random
+import threading
+import time
+from collections import Counter
+from uuid import uuid4
+
+# Marker for an attribute an item does not have
+_MISSING = object()
+
+# Raised in place of a network or server error when a failure is injected
+class EmulatedFailure(Exception):
+    pass
+
+# Define the update operations of the deta SDK's Base.util
+class Util:
+    class Trim:
+        pass
+
+    class Increment:
+        def __init__(self, value=1):
+            self.val = value
+
+    class Append:
+        def __init__(self, value):
+            self.val = value if isinstance(value, list) else [value]
+
+    class Prepend:
+        def __init__(self, value):
+            self.val = value if isinstance(value, list) else [value]
+
+    def trim(self):
+        return self.Trim()
+
+    def increment(self, value=1):
+        return self.Increment(value)
+
+    def append(self, value):
+        return self.Append(value)
+
+    def prepend(self, value):
+        return self.Prepend(value)
+
+# Define the result of a fetch, like the deta SDK's FetchResponse
+class FetchResponse:
+    def __init__(self, count: int, last, items: list):
+        self.count = count
+        self.last = last
+        self.items = items
+
+# Get the value at a dotted path of an item, or _MISSING
+def _lookup(item: dict, path: str):
+    value = item
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+# Compare with an ordering operator, treating missing attributes and mismatched types as no match
+def _compare(op):
+    def compare(value, operand):
+        if value is _MISSING:
+            return False
+        try:
+            return op(value, operand)
+        except TypeError:
+            return False
+    return compare
+
+# Query operators by their suffix in a query key, e.g. "price?gte"
+OPERATORS = {
+    "eq": lambda value, operand: value == operand,
+    "ne": lambda value, operand: value != operand,
+    "lt": _compare(lambda value, operand: value < operand),
+    "gt": _compare(lambda value, operand: value > operand),
+    "lte": _compare(lambda value, operand: value <= operand),
+    "gte": _compare(lambda value, operand: value >= operand),
+    "pfx": lambda value, operand: isinstance(value, str) and value.startswith(operand),
+    "r": _compare(lambda value, operand: operand[0] <= value <= operand[1]),
+    "contains": lambda value, operand: isinstance(value, (str, list)) and operand in value,
+    "not_contains": lambda value, operand: not (isinstance(value, (str, list)) and operand in value),
+}
+
+# Check whether an item matches a query; a list of queries matches if any of them does
+def _matches(item: dict, query):
+    if not query:
+        return True
+    if isinstance(query, list):
+        return any(_matches(item, q) for q in query)
+    for condition, operand in query.items():
+        path, _, op = condition.partition("?")
+        if op not in OPERATORS and op:
+            raise ValueError(f"Unknown query operator: {op}")
+        if not OPERATORS[op or "eq"](_lookup(item, path), operand):
+            return False
+    return True
+
+# Define an emulated Deta Base holding its items in memory
+class Base:
+    def __init__(self, name: str, deta: "Deta"):
+        self.name = name
+        self.deta = deta
+        self.items = {}
+        self.lock = threading.Lock()
+        self.util = Util()
+        # Number of calls made to each operation, i.e. the round trips a real Base would have made
+        self.calls = Counter()
+
+    # Count the call, then wait out the injected latency and raise an injected failure if one is drawn
+    def _round_trip(self, operation: str):
+        self.calls[operation] += 1
+        delay, fail = self.deta.draw()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise EmulatedFailure(f"Injected failure in {self.name}.{operation}")
+
+    # Get a stored item if it exists and has not expired
+    def _live(self, key: str):
+        item = self.items.get(key)
+        if item is not None and item.get("__expires", float("inf")) <= time.time():
+            del self.items[key]
+            return None
+        return item
+
+    # Build the stored form of an item, with its key and expiry
+    def _prepare(self, data, key=None, expire_in=None, expire_at=None):
+        item = copy.deepcopy(data) if isinstance(data, dict) else {"value": copy.deepcopy(data)}
+        if key is not None:
+            item["key"] = key
+        item["key"] = str(item.get("key") or uuid4().hex[:12])
+        if expire_in is not None:
+            item["__expires"] = time.time() + expire_in
+        elif expire_at is not None:
+            item["__expires"] = expire_at.timestamp() if hasattr(expire_at, "timestamp") else float(expire_at)
+        return item
+
+    def get(self, key: str):
+        self._round_trip("get")
+        with self.lock:
+            item = self._live(key)
+            return copy.deepcopy(item) if item is not None else None
+
+    def put(self, data, key: str = None, *, expire_in: int = None, expire_at=None):
+        self._round_trip("put")
+        item = self._prepare(data, key, expire_in, expire_at)
+        with self.lock:
+            self.items[item["key"]] = item
+        return copy.deepcopy(item)
+
+    def put_many(self, items: list, *, expire_in: int = None, expire_at=None):
+        if len(items) > 25:
+            raise ValueError("We can't put more than 25 items at a time.")
+        self._round_trip("put_many")
+        prepared = [self._prepare(data, None, expire_in, expire_at) for data in items]
+        with self.lock:
+            for item in prepared:
+                self.items[item["key"]] = item
+        return {"processed": {"items": copy.deepcopy(prepared)}}
+
+    def insert(self, data, key: str = None, *, expire_in: int = None, expire_at=None):
+        self._round_trip("insert")
+        item = self._prepare(data, key, expire_in, expire_at)
+        with self.lock:
+            if self._live(item["key"]) is not None:
+                raise Exception(f"Item with key '{item['key']}' already exists")
+            self.items[item["key"]] = item
+        return copy.deepcopy(item)
+
+    def update(self, updates: dict, key: str, *, expire_in: int = None, expire_at=None):
+        self._round_trip("update")
+        with self.lock:
+            item = self._live(key)
+            if item is None:
+                raise Exception(f"Key '{key}' not found")
+            # Apply the whole update to a copy so a bad operation leaves the item unchanged
+            item = copy.deepcopy(item)
+            for path, value in updates.items():
+                *parents, field = path.split(".")
+                target = item
+                for part in parents:
+                    target = target.setdefault(part, {})
+                if isinstance(value, Util.Trim):
+                    target.pop(field, None)
+                elif isinstance(value, Util.Increment):
+                    target[field] = target.get(field, 0) + value.val
+                elif isinstance(value, Util.Append):
+                    target[field] = target.get(field, []) + value.val
+                elif isinstance(value, Util.Prepend):
+                    target[field] = value.val + target.get(field, [])
+                else:
+                    target[field] = copy.deepcopy(value)
+            if expire_in is not None or expire_at is not None:
+                item = self._prepare(item, key, expire_in, expire_at)
+            self.items[key] = item
+
+    def delete(self, key: str):
+        self._round_trip("delete")
+        with self.lock:
+            self.items.pop(key, None)
+
+    def fetch(self, query=None, *, limit: int = 1000, last: str = None):
+        self._round_trip("fetch")
+        with self.lock:
+            # Items come back in key order, starting after the last key of the previous page
+            keys = sorted(key for key in self.items if last is None or key > last)
+            items = []
+            next_last = None
+            for key in keys:
+                item = self._live(key)
+                if item is None or not _matches(item, query):
+                    continue
+                if len(items) == limit:
+                    next_last = items[-1]["key"]
+                    break
+                items.append(copy.deepcopy(item))
+        return FetchResponse(len(items), next_last, items)
+
+# Define the emulated Deta project, handing out one Base per name
+class Deta:
+    def __init__(self, project_key: str = None, *, latency: float = 0.0, jitter: float = 0.0,
+                 failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.bases = {}
+
+    # Draw the latency and whether to fail for one round trip
+    def draw(self):
+        with self.random_lock:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            fail = self.failure_rate > 0 and self.random.random() < self.failure_rate
+        return delay, fail
+
+    def Base(self, name: str):
+        if name not in self.bases:
+            self.bases[name] = Base(name, self)
+        return self.bases[name]
+
+    # Get the number of calls made to each operation of each base
+    def stats(self):
+        return {name: dict(base.calls) for name, base in self.bases.items()}
+
+    # Forget all items and call counts
+    def reset(self):
+        for base in self.bases.values():
+            with base.lock:
+                base.items.clear()
+                base.calls.clear()
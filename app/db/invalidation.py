@@ -0,0 +1,145 @@
+# invalidation.py
+import abc
+import json
+import logging
+import os
+import socket
+import threading
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Handlers to call when an entity changes, by entity name
+handlers = {}
+
+# Define the interface for delivering change events to the other workers
+class Broker(abc.ABC):
+    # Send an encoded event to every other worker
+    @abc.abstractmethod
+    def publish(self, message: bytes):
+        pass
+
+    # Start receiving events from other workers, passing each one to callback
+    @abc.abstractmethod
+    def start(self, callback):
+        pass
+
+    def close(self):
+        pass
+
+# Define a broker for a single process, where there is nobody else to tell
+class LocalBroker(Broker):
+    def publish(self, message: bytes):
+        pass
+
+    def start(self, callback):
+        pass
+
+# Define a broker that fans events out over Unix datagram sockets, one per worker in a shared directory
+class UnixSocketBroker(Broker):
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}.sock")
+        self.sock = None
+        self.thread = None
+
+    def publish(self, message: bytes):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+            # Never let a slow worker hold up the write that published the event
+            sender.setblocking(False)
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if path == self.path or not name.endswith(".sock"):
+                    continue
+                try:
+                    sender.sendto(message, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The worker that owned this socket is gone
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                except BlockingIOError:
+                    # The worker's queue is full; wait briefly for it to drain before giving up on it
+                    try:
+                        sender.settimeout(0.05)
+                        sender.sendto(message, path)
+                    except OSError:
+                        logger.warning("Dropped invalidation event for busy worker %s", name)
+                    finally:
+                        sender.setblocking(False)
+
+    def start(self, callback):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.thread = threading.Thread(target=self._listen, args=(callback,), daemon=True)
+        self.thread.start()
+
+    def _listen(self, callback):
+        while True:
+            try:
+                message = self.sock.recv(65536)
+            except OSError:
+                # The socket was closed
+                return
+            try:
+                callback(message)
+            except Exception:
+                logger.exception("Failed to apply invalidation event")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+# Create the broker configured for this deployment
+def _create_broker():
+    if settings.invalidation_broker == "unix":
+        return UnixSocketBroker(settings.invalidation_socket_dir)
+    return LocalBroker()
+
+broker = _create_broker()
+
+# Define a decorator to register a handler called with the key of each changed entity
+def subscribe(entity: str):
+    def decorator(func):
+        handlers.setdefault(entity, []).append(func)
+        return func
+    return decorator
+
+# Call the handlers for a changed entity in this worker, e.g. for a change learned of other than by an event
+def apply(entity: str, key: str):
+    for handler in handlers.get(entity, []):
+        handler(key)
+
+# Decode an event received from another worker and apply it
+def _receive(message: bytes):
+    event = json.loads(message)
+    apply(event["entity"], event["key"])
+
+# Define a function to announce that an entity changed, applying it here and in every other worker
+def publish(entity: str, key: str):
+    apply(entity, key)
+    try:
+        broker.publish(json.dumps({"entity": entity, "key": key}).encode())
+    except Exception:
+        logger.exception("Failed to publish invalidation event for %s %s", entity, key)
+
+# Replace the broker, e.g. with one backed by an external message bus
+def set_broker(new_broker: Broker):
+    global broker
+    broker.close()
+    broker = new_broker
+
+# Start receiving events from other workers
+def start():
+    broker.start(_receive)
+
+# Stop receiving events from other workers
+def stop():
+    broker.close()
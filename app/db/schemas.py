@@ -1,6 +1,6 @@
 # schemas.py
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 class Category(BaseModel):
     key: str
@@ -24,6 +24,7 @@ class ProductCreate(BaseModel):
     price: float
     image: str
     category: CategoryCreate
+    stock: int = 0
 
 # Define a schema for updating a product
 class ProductUpdate(BaseModel):
@@ -32,6 +33,8 @@ class ProductUpdate(BaseModel):
     price: Optional[float] = None
     image: Optional[str] = None
     category: Optional[Category] = None
+    # The version the client last read; if set, the update fails when the product has changed since
+    version: Optional[int] = None
 
 # Define a schema for reading a product
 class Product(BaseModel):
@@ -41,6 +44,43 @@ class Product(BaseModel):
     price: float
     image: str
     category: Category
+    # None for sharded products; their stock is read from the stock endpoint
+    stock: Optional[int] = 0
+    version: int = 0
+
+# Define a schema for requesting several records by key at once
+class BatchRequest(BaseModel):
+    keys: List[str]
+
+# Define a schema for one result of a product batch request; product is None if the key was not found
+class ProductBatchItem(BaseModel):
+    key: str
+    product: Optional[Product] = None
+
+# Define a schema for reading the results of a product batch request, in the order of the requested keys
+class ProductBatch(BaseModel):
+    items: List[ProductBatchItem]
+
+# Define a schema for reserving stock of a product
+class ReservationCreate(BaseModel):
+    quantity: int = 1
+
+# Define a schema for reading a reservation
+class Reservation(BaseModel):
+    key: str
+    product_key: str
+    user_key: str
+    quantity: int
+    expires_at: float
+
+# Define a schema for restocking or writing off units of a product; negative to remove units
+class StockAdjust(BaseModel):
+    delta: int
+
+# Define a schema for reading the stock of a product
+class Stock(BaseModel):
+    product_key: str
+    stock: int
 
 # Define a schema for creating a user
 class UserCreate(BaseModel):
@@ -67,6 +107,38 @@ class User(BaseModel):
     is_active: bool
     is_admin: bool
 
+# Define a schema for listing users, which never carries the password hash
+class UserSummary(BaseModel):
+    key: str
+    username: str
+    email: str
+    is_active: bool
+    is_admin: bool
+
+# Define a schema for reading a page of users; pass last back as the cursor to get the next page
+class UserPage(BaseModel):
+    items: List[UserSummary]
+    last: Optional[str] = None
+
+# Define a schema for activating or deactivating several users at once
+class UserBulkActivate(BaseModel):
+    keys: List[str]
+    is_active: bool
+
+# Define a schema for reading the result of a bulk user update
+class UserBulkResult(BaseModel):
+    updated: List[str]
+    missing: List[str]
+
+# Define a schema for one result of a user batch request; user is None if the key was not found
+class UserBatchItem(BaseModel):
+    key: str
+    user: Optional[UserSummary] = None
+
+# Define a schema for reading the results of a user batch request, in the order of the requested keys
+class UserBatch(BaseModel):
+    items: List[UserBatchItem]
+
 # Define a schema for creating a cart item
 class CartItemCreate(BaseModel):
     user_key: str
@@ -0,0 +1,387 @@
+# snapshot.py
+#
+# A catalog snapshot is a columnar binary file in native byte order:
+#
+#   header      magic, created_at, product count, category count, string count
+#   strings     u32 offsets (count + 1) followed by the utf-8 blob they index
+#   products    key, name, description, image, category (u32 string/category indexes),
+#               price (f64), stock, stock_shards, version (i64), sorted by key
+#   categories  key, name, description (u32 string indexes)
+#
+# Every section starts on an 8 byte boundary so columns can be cast in place from an mmap.
+# Workers share the mapped pages, and writes made after the snapshot are replayed from the delta log,
+# which every worker follows so it sees changes whose invalidation events it missed.
+import argparse
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from core.config import settings
+from . import base, invalidation
+
+MAGIC = b"CATSNAP1"
+HEADER = struct.Struct("=8sdIII")
+
+# The loaded snapshot, products changed since it was taken (None if deleted), and keys still to re-read
+_snapshot = None
+_overlay = {}
+_dirty = set()
+
+# How far this worker has followed the delta log: the snapshot path, the log file kept open at the position read up
+# to, the time changes are read from, the newest change read, and the log's size when it was last compacted
+_delta = {"path": None, "file": None, "since": 0.0, "seen": 0.0, "compacted_size": 0}
+_delta_lock = threading.Lock()
+
+# Fetch every item matching a query, following Deta's paging
+def _fetch_all(db, query=None):
+    res = db.fetch(query)
+    items = res.items
+    while res.last:
+        res = db.fetch(query, last=res.last)
+        items += res.items
+    return items
+
+# Pad a buffer to the next 8 byte boundary
+def _align(buffer: bytearray):
+    buffer += b"\0" * (-len(buffer) % 8)
+
+# Define a function to write the products and categories to a snapshot file
+def write(path: str, products: list, categories: list, created_at: float):
+    strings = {}
+    def intern(value: str):
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    category_index = {}
+    category_rows = []
+    def add_category(category: dict):
+        row = (category["key"], category["name"], category["description"])
+        if row not in category_index:
+            category_index[row] = len(category_rows)
+            category_rows.append(row)
+        return category_index[row]
+
+    for category in categories:
+        add_category(category)
+    products = sorted(products, key=lambda product: product["key"])
+    keys, names, descriptions, images, product_categories = (array("I") for _ in range(5))
+    prices = array("d")
+    stocks, stock_shards, versions = (array("q") for _ in range(3))
+    for product in products:
+        keys.append(intern(product["key"]))
+        names.append(intern(product["name"]))
+        descriptions.append(intern(product["description"]))
+        images.append(intern(product["image"]))
+        product_categories.append(add_category(product["category"]))
+        prices.append(product["price"])
+        stocks.append(product.get("stock", 0))
+        stock_shards.append(product.get("stock_shards", 0))
+        versions.append(product.get("version", 0))
+    category_keys, category_names, category_descriptions = (array("I") for _ in range(3))
+    for key, name, description in category_rows:
+        category_keys.append(intern(key))
+        category_names.append(intern(name))
+        category_descriptions.append(intern(description))
+
+    blob = bytearray()
+    offsets = array("I", [0])
+    for value in strings:
+        blob += value.encode()
+        offsets.append(len(blob))
+
+    buffer = bytearray(HEADER.pack(MAGIC, created_at, len(products), len(category_rows), len(strings)))
+    for column in (offsets, blob, keys, names, descriptions, images, product_categories, prices, stocks,
+                   stock_shards, versions, category_keys, category_names, category_descriptions):
+        _align(buffer)
+        buffer += column if isinstance(column, bytearray) else column.tobytes()
+    # Write to a temporary file and swap it in, so workers that mapped the old file keep a consistent view
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buffer)
+    os.replace(tmp_path, path)
+
+# Define a read-only view over a memory-mapped snapshot file
+class Snapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Exports replace the file, so a different inode at the path means there is a newer snapshot
+            self.inode = os.fstat(f.fileno()).st_ino
+        magic, self.created_at, self.product_count, self.category_count, string_count = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        self.view = memoryview(self.mm)
+        self.offset = HEADER.size
+        self.string_offsets = self._column("I", string_count + 1)
+        self.blob = self._column("B", self.string_offsets[-1])
+        self.keys = self._column("I", self.product_count)
+        self.names = self._column("I", self.product_count)
+        self.descriptions = self._column("I", self.product_count)
+        self.images = self._column("I", self.product_count)
+        self.product_categories = self._column("I", self.product_count)
+        self.prices = self._column("d", self.product_count)
+        self.stocks = self._column("q", self.product_count)
+        self.stock_shards = self._column("q", self.product_count)
+        self.versions = self._column("q", self.product_count)
+        self.category_keys = self._column("I", self.category_count)
+        self.category_names = self._column("I", self.category_count)
+        self.category_descriptions = self._column("I", self.category_count)
+
+    # Cast the next section of the file to a column without copying it
+    def _column(self, fmt: str, count: int):
+        self.offset += -self.offset % 8
+        size = struct.calcsize(fmt) * count
+        column = self.view[self.offset:self.offset + size].cast(fmt)
+        self.offset += size
+        return column
+
+    def string(self, index: int):
+        return bytes(self.blob[self.string_offsets[index]:self.string_offsets[index + 1]]).decode()
+
+    def category(self, index: int):
+        return {
+            "key": self.string(self.category_keys[index]),
+            "name": self.string(self.category_names[index]),
+            "description": self.string(self.category_descriptions[index]),
+        }
+
+    # Get the product at a row as a dictionary, decoding only the given fields if any
+    def product(self, row: int, fields=None):
+        getters = {
+            "key": lambda: self.string(self.keys[row]),
+            "name": lambda: self.string(self.names[row]),
+            "description": lambda: self.string(self.descriptions[row]),
+            "price": lambda: self.prices[row],
+            "image": lambda: self.string(self.images[row]),
+            "category": lambda: self.category(self.product_categories[row]),
+            "stock": lambda: self.stocks[row],
+            "stock_shards": lambda: self.stock_shards[row],
+            "version": lambda: self.versions[row],
+        }
+        return {field: getters[field]() for field in (fields or getters)}
+
+    # Find the row of a product by key with a binary search over the sorted key column
+    def find(self, key: str):
+        low, high = 0, self.product_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.string(self.keys[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.product_count and self.string(self.keys[low]) == key:
+            return low
+        return None
+
+    def close(self):
+        # Release the columns before the view they were cast from
+        for column in reversed(list(vars(self).values())):
+            if isinstance(column, memoryview):
+                column.release()
+        self.mm.close()
+
+# Get the path of the delta log that records product writes made after a snapshot
+def _delta_path(path: str):
+    return f"{path}.delta"
+
+# Hold the lock on a delta log: shared by workers appending to it, exclusive while it is compacted or rotated
+@contextmanager
+def _log_lock(path: str, operation: int):
+    with open(f"{_delta_path(path)}.lock", "a") as f:
+        fcntl.flock(f, operation)
+        yield
+
+# Record that a product changed, so workers started from an older snapshot re-read it
+def log_change(key: str):
+    if not settings.catalog_snapshot_path:
+        return
+    with _log_lock(settings.catalog_snapshot_path, fcntl.LOCK_SH):
+        with open(_delta_path(settings.catalog_snapshot_path), "a") as f:
+            f.write(f"{time.time()} {key}\n")
+
+# Read the lines appended to the delta log since it was last read and return the keys they name; call with
+# _delta_lock held
+def _read_delta(path: str):
+    if _delta["file"] is None:
+        try:
+            _delta["file"] = open(_delta_path(path), "rb")
+        except FileNotFoundError:
+            return set()
+    f = _delta["file"]
+    data = f.read()
+    # Leave a line that is still being written for the next read
+    f.seek(f.tell() - len(data) + data.rfind(b"\n") + 1)
+    keys = set()
+    for line in data[:data.rfind(b"\n") + 1].decode().splitlines():
+        timestamp, _, key = line.partition(" ")
+        if key and float(timestamp) >= _delta["since"]:
+            keys.add(key)
+            _delta["seen"] = max(_delta["seen"], float(timestamp))
+    try:
+        replaced = os.stat(_delta_path(path)).st_ino != os.fstat(f.fileno()).st_ino
+    except FileNotFoundError:
+        replaced = True
+    if replaced:
+        # The log was rotated by an export or compacted, and the open file has been read to its end. Read the new
+        # one from the top, skipping what was seen already; lines may land slightly out of time order.
+        f.close()
+        _delta["file"] = None
+        _delta["since"] = _delta["seen"] - 1.0
+        keys |= _read_delta(path)
+    return keys
+
+# Rewrite the delta log with the latest change of each product made since the snapshot, so it stays about the size
+# of the catalog however many writes happen between exports
+def _compact(path: str):
+    latest = {}
+    with _log_lock(path, fcntl.LOCK_EX):
+        with open(_delta_path(path)) as f:
+            for line in f:
+                timestamp, _, key = line.strip().partition(" ")
+                if key and float(timestamp) >= _snapshot.created_at:
+                    latest[key] = max(float(timestamp), latest.get(key, 0.0))
+        tmp_path = f"{_delta_path(path)}.tmp"
+        with open(tmp_path, "w") as f:
+            for key, timestamp in sorted(latest.items(), key=lambda item: item[1]):
+                f.write(f"{timestamp} {key}\n")
+            size = f.tell()
+        os.replace(tmp_path, _delta_path(path))
+    _delta["compacted_size"] = size
+
+# Define a function to export the catalog from storage to a snapshot file
+def export(path: str):
+    # Start a fresh delta log first; anything written from now on is either in the snapshot or in the new log
+    created_at = time.time()
+    with _log_lock(path, fcntl.LOCK_EX):
+        if os.path.exists(_delta_path(path)):
+            os.replace(_delta_path(path), f"{_delta_path(path)}.old")
+    products = _fetch_all(base.products_db)
+    categories = _fetch_all(base.categories_db)
+    write(path, products, categories, created_at)
+    if os.path.exists(f"{_delta_path(path)}.old"):
+        os.unlink(f"{_delta_path(path)}.old")
+    return {"path": path, "products": len(products), "categories": len(categories), "created_at": created_at}
+
+# Define a function to map a snapshot and mark products written since it was taken for re-reading
+def load(path: str):
+    global _snapshot
+    snapshot = Snapshot(path)
+    with _delta_lock:
+        # Read the log from the top; changes older than the snapshot are in it already
+        if _delta["file"] is not None:
+            _delta["file"].close()
+        _delta.update(path=path, file=None, since=snapshot.created_at, seen=snapshot.created_at)
+        dirty = _read_delta(path)
+        _overlay.clear()
+        _dirty.clear()
+        _dirty.update(dirty)
+        # The previous snapshot is left for the garbage collector, since requests may still be reading it
+        _snapshot = snapshot
+    return snapshot
+
+# Define a function to pick up the products changed since the delta log was last read, and a snapshot exported
+# since this one was loaded. Invalidation events are best effort, so this bounds how long a change goes unseen.
+def poll():
+    if _snapshot is None:
+        return
+    path = _delta["path"]
+    with _delta_lock:
+        keys = _read_delta(path)
+        size = _delta["file"].tell() if _delta["file"] else 0
+        compact = size > max(settings.catalog_delta_max_bytes, 2 * _delta["compacted_size"])
+    # Apply the changes like events from other workers, so the caches drop them too
+    for key in keys:
+        invalidation.apply("product", key)
+    try:
+        if os.stat(path).st_ino != _snapshot.inode:
+            load(path)
+            return
+    except FileNotFoundError:
+        pass
+    if compact:
+        _compact(path)
+
+def loaded():
+    return _snapshot is not None
+
+# Forget the overlay entry of a changed product so the next read fetches it from storage
+@invalidation.subscribe("product")
+def _mark_dirty(key: str):
+    _overlay.pop(key, None)
+    _dirty.add(key)
+
+# Re-read the products that changed since the snapshot or since they were last read
+def _refresh():
+    for key in list(_dirty):
+        _dirty.discard(key)
+        _overlay[key] = base.products_db.get(key)
+
+# Keep only the given fields of a product read from storage
+def _project(product: dict, fields):
+    if not fields:
+        return product
+    return {field: product[field] for field in fields if field in product}
+
+# Get a product by key from the snapshot, or None if it is not there
+def get_product(key: str, fields=None):
+    if key in _dirty:
+        _dirty.discard(key)
+        _overlay[key] = base.products_db.get(key)
+    if key in _overlay:
+        return _overlay[key] and _project(_overlay[key], fields)
+    row = _snapshot.find(key)
+    if row is None:
+        return None
+    return _snapshot.product(row, fields)
+
+# Check whether a product matches the filters of a product listing
+def _matches(product: dict, category, min_price, max_price):
+    if category and category not in product["category"]["name"]:
+        return False
+    if min_price is not None and product["price"] < min_price:
+        return False
+    if max_price is not None and product["price"] > max_price:
+        return False
+    return True
+
+# Get the products matching a listing's filters from the snapshot and the products changed since,
+# decoding only the given fields if any (they must include the key)
+def get_products(category=None, min_price=None, max_price=None, fields=None):
+    _refresh()
+    # Check the category filter once per category rather than once per product
+    categories = None
+    if category:
+        categories = {i for i in range(_snapshot.category_count)
+                      if category in _snapshot.string(_snapshot.category_names[i])}
+    products = []
+    for row in range(_snapshot.product_count):
+        price = _snapshot.prices[row]
+        if min_price is not None and price < min_price:
+            continue
+        if max_price is not None and price > max_price:
+            continue
+        if categories is not None and _snapshot.product_categories[row] not in categories:
+            continue
+        if _snapshot.string(_snapshot.keys[row]) not in _overlay:
+            products.append(_snapshot.product(row, fields))
+    products += [_project(product, fields) for product in list(_overlay.values())
+                 if product and _matches(product, category, min_price, max_price)]
+    # Keep the key order a storage fetch would return
+    products.sort(key=lambda product: product["key"])
+    return products
+
+
+if __name__ == "__main__":
+    # Export a snapshot from the command line: python -m db.snapshot [path]
+    parser = argparse.ArgumentParser(description="Export the catalog to a snapshot file")
+    parser.add_argument("path", nargs="?", default=settings.catalog_snapshot_path)
+    args = parser.parse_args()
+    if not args.path:
+        sys.exit("No snapshot path given and APP_CATALOG_SNAPSHOT_PATH is not set")
+    print(export(args.path))
@@ -1,7 +1,13 @@
 # main.py
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from api.routes import auth, cart, checkout, products
+from api.compression import CompressionMiddleware
+from api.routes import auth, cart, checkout, jobs as jobs_routes, products
+# Import the email service so its job handlers are registered before workers start
+from services import catalog, email, inventory, jobs
+from core.config import settings
+from db import invalidation, snapshot
 
 # Create the app instance
 app = FastAPI()
@@ -20,9 +26,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large responses for clients that accept gzip or brotli
+app.add_middleware(CompressionMiddleware, minimum_size=settings.compression_min_size)
+
 # Register the routers for the API endpoints
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 # app.include_router(cart.router)
 # app.include_router(checkout.router)
 app.include_router(products.router, prefix="/products", tags=["products"])
+app.include_router(jobs_routes.router, prefix="/jobs", tags=["jobs"])
+
+# Start the invalidation listener, the background job workers and the reservation sweeper, and map the catalog snapshot
+# and follow its delta log
+@app.on_event("startup")
+async def startup():
+    invalidation.start()
+    # Warm the catalog from the snapshot instead of starting cold
+    if settings.catalog_snapshot_path and os.path.exists(settings.catalog_snapshot_path):
+        snapshot.load(settings.catalog_snapshot_path)
+    await catalog.start()
+    await jobs.start()
+    await inventory.start()
+
+# Stop the background tasks; unfinished jobs stay queued for the next start
+@app.on_event("shutdown")
+async def shutdown():
+    await inventory.stop()
+    await jobs.stop()
+    await catalog.stop()
+    invalidation.stop()
 
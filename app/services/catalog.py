@@ -0,0 +1,32 @@
+# catalog.py
+import asyncio
+import logging
+from core.config import settings
+from db import snapshot
+
+logger = logging.getLogger(__name__)
+
+# The task that follows the catalog snapshot's delta log
+_follower = None
+
+# Define the loop that picks up catalog changes made by other workers, including those whose events were lost
+async def _follow():
+    while True:
+        try:
+            await asyncio.to_thread(snapshot.poll)
+        except Exception:
+            logger.exception("Failed to read the catalog delta log")
+        await asyncio.sleep(settings.catalog_delta_poll_seconds)
+
+# Start following the delta log
+async def start():
+    global _follower
+    _follower = asyncio.create_task(_follow())
+
+# Stop following the delta log
+async def stop():
+    global _follower
+    if _follower is not None:
+        _follower.cancel()
+        await asyncio.gather(_follower, return_exceptions=True)
+        _follower = None
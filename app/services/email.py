@@ -1,17 +1,26 @@
+import asyncio
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from datetime import timedelta
+from typing import Optional
 from core.config import settings
+from core.security import create_access_token
 from pydantic import EmailStr
+from services.jobs import job
 
-# Define a smtp instance with the admin email and password
-smtp = smtplib.SMTP_SSL(settings.email_host, settings.email_port)
-smtp.login(settings.email_username, settings.email_password)
+# Define a function to send a message over a new smtp connection with the admin email and password
+def _send_message(message: MIMEMultipart):
+    with smtplib.SMTP_SSL(settings.email_host, settings.email_port) as smtp:
+        smtp.login(settings.email_username, settings.email_password)
+        smtp.send_message(message)
 
-
-
-# Define a function to send a verification email given an email and a token
-async def send_verification_email(email: EmailStr, token: str):
+# Define a function to send a verification email given an email and the key of the user to verify.
+# The token is created here rather than queued, so bearer tokens are never stored in the job queue;
+# token is only passed by jobs queued before that.
+@job("send_verification_email")
+async def send_verification_email(email: EmailStr, user_key: Optional[str] = None, token: Optional[str] = None):
+    token = token or create_access_token(user_key)
     # Create a verification link with the token as a query parameter
     link = f"{settings.app_url}/verify/{token}"
     # Create a message schema with the email, subject, body, and subtype
@@ -30,13 +39,14 @@ async def send_verification_email(email: EmailStr, token: str):
     """
     part = MIMEText(html, 'html')
     message.attach(part)
-    # Send the message using the smtp
-    smtp.send_message(message)
-    smtp.quit()
-    
+    # Send the message in a thread so a slow smtp server does not block the job workers
+    await asyncio.to_thread(_send_message, message)
 
-# Define a function to send a password reset email given an email and a token
-async def send_password_reset_email(email: EmailStr, token: str):
+# Define a function to send a password reset email given an email and the key of the user, creating a token
+# with a short expiration time like the verification email does
+@job("send_password_reset_email")
+async def send_password_reset_email(email: EmailStr, user_key: Optional[str] = None, token: Optional[str] = None):
+    token = token or create_access_token(user_key, expires_delta=timedelta(minutes=15))
     # Create a password reset link with the token as a query parameter
     link = f"{settings.app_url}/reset-password/{token}"
     # Create a message schema with the email, subject, body, and subtype
@@ -55,11 +65,11 @@ async def send_password_reset_email(email: EmailStr, token: str):
     """
     part = MIMEText(html, 'html')
     message.attach(part)
-    # Send the message using the smtp
-    smtp.send_message(message)
-    smtp.quit()
+    # Send the message in a thread so a slow smtp server does not block the job workers
+    await asyncio.to_thread(_send_message, message)
 
 # Define a function to send an order confirmation email given an email and an order id
+@job("send_order_confirmation_email")
 async def send_order_confirmation_email(email: EmailStr, order_id: str):
     # Create an order details link with the order id as a query parameter
     link = f"{settings.app_url}/order-details/{order_id}"
@@ -79,6 +89,5 @@ async def send_order_confirmation_email(email: EmailStr, order_id: str):
     """
     part = MIMEText(html, 'html')
     message.attach(part)
-    # Send the message using the smtp
-    smtp.send_message(message)
-    smtp.quit()
+    # Send the message in a thread so a slow smtp server does not block the job workers
+    await asyncio.to_thread(_send_message, message)
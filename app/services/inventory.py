@@ -0,0 +1,35 @@
+# inventory.py
+import asyncio
+import logging
+from core.config import settings
+from db import crud
+
+logger = logging.getLogger(__name__)
+
+# The task that periodically releases expired reservations
+_sweeper = None
+
+# Define the loop that returns the units of expired reservations to stock
+async def _sweep():
+    while True:
+        try:
+            # Every worker sweeps; reservations are claimed exactly once so this is safe
+            released = await asyncio.to_thread(crud.release_expired_reservations)
+            if released:
+                logger.info("Released %d expired reservations", released)
+        except Exception:
+            logger.exception("Failed to release expired reservations")
+        await asyncio.sleep(settings.reservation_sweep_interval)
+
+# Start the reservation sweeper
+async def start():
+    global _sweeper
+    _sweeper = asyncio.create_task(_sweep())
+
+# Stop the reservation sweeper
+async def stop():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        await asyncio.gather(_sweeper, return_exceptions=True)
+        _sweeper = None
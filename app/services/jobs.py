@@ -0,0 +1,232 @@
+# jobs.py
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Registry of job handlers by name
+handlers = {}
+
+# Per-job metrics by name
+metrics = {}
+
+# Define a decorator to register a coroutine as a job handler under a name
+def job(name: str):
+    def decorator(func):
+        handlers[name] = func
+        return func
+    return decorator
+
+# Define a durable job queue stored in a local SQLite file
+class JobQueue:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                key TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_error TEXT,
+                owner INTEGER,
+                lease_until REAL
+            )
+            """
+        )
+        # Add the lease columns to queues created before jobs were leased
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "INTEGER"), ("lease_until", "REAL")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at)")
+
+    # Add a new pending job and return its key
+    def put(self, name: str, payload: dict, delay: float = 0):
+        key = f"job_{uuid4().hex}"
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (key, name, payload, status, run_at, created_at) VALUES (?, ?, ?, 'pending', ?, ?)",
+                (key, name, json.dumps(payload), now + delay, now),
+            )
+        return key
+
+    # Atomically claim the next due job for a lease, or return None if there is nothing to run.
+    # A running job whose lease expired belonged to a worker that died, so it is claimed again.
+    def claim(self, lease: float):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    """
+                    SELECT key, name, payload, attempts FROM jobs
+                    WHERE (status = 'pending' AND run_at <= ?) OR (status = 'running' AND lease_until < ?)
+                    ORDER BY run_at LIMIT 1
+                    """,
+                    (now, now),
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, owner = ?, lease_until = ? WHERE key = ?",
+                        (os.getpid(), now + lease, row[0]),
+                    )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return {"key": row[0], "name": row[1], "payload": json.loads(row[2]), "attempts": row[3] + 1}
+
+    # Remove a job that finished successfully
+    def complete(self, key: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE key = ?", (key,))
+
+    # Put a failed job back in the queue to run again after a delay
+    def retry(self, key: str, delay: float, error: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'pending', run_at = ?, last_error = ?, owner = NULL, lease_until = NULL WHERE key = ?",
+                (time.time() + delay, error, key),
+            )
+
+    # Move a job that ran out of attempts to the dead-letter state
+    def bury(self, key: str, error: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'dead', last_error = ?, owner = NULL, lease_until = NULL WHERE key = ?",
+                (error, key),
+            )
+
+    # Get the dead-lettered jobs, without their payloads, which may hold tokens or personal data
+    def dead(self, limit: int = 100):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, name, attempts, created_at, last_error FROM jobs WHERE status = 'dead' ORDER BY created_at LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            {"key": r[0], "name": r[1], "attempts": r[2], "created_at": r[3], "last_error": r[4]}
+            for r in rows
+        ]
+
+    # Get the number of jobs in each state
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Create the queue instance
+queue = JobQueue(settings.jobs_db_path)
+
+# The worker tasks and the event used to wake them when a job is enqueued
+_workers = []
+_wakeup = None
+_loop = None
+
+# Get the metrics record for a job name, creating it if needed
+def _metrics_for(name: str):
+    if name not in metrics:
+        metrics[name] = {"enqueued": 0, "succeeded": 0, "failed": 0, "retried": 0, "dead": 0, "total_seconds": 0.0}
+    return metrics[name]
+
+# Define a function to enqueue a job by name with keyword arguments for its handler
+def enqueue(name: str, delay: float = 0, **kwargs):
+    if name not in handlers:
+        raise ValueError(f"Unknown job: {name}")
+    key = queue.put(name, kwargs, delay)
+    _metrics_for(name)["enqueued"] += 1
+    # Wake a worker; enqueue is usually called from the threadpool running sync endpoints
+    if _loop is not None and _wakeup is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+    return key
+
+# Run a single claimed job and record the outcome
+async def _run(item: dict):
+    name = item["name"]
+    stats = _metrics_for(name)
+    handler = handlers.get(name)
+    started = time.monotonic()
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job: {name}")
+        # A job may not outlive its lease, or another worker would claim it again
+        await asyncio.wait_for(handler(**item["payload"]), timeout=settings.jobs_lease_seconds)
+    except asyncio.CancelledError:
+        # Shutting down; hand the job back rather than waiting for its lease to expire
+        queue.retry(item["key"], 0, "Interrupted by shutdown")
+        raise
+    except Exception as e:
+        stats["failed"] += 1
+        error = f"{type(e).__name__}: {e}"
+        if item["attempts"] >= settings.jobs_max_attempts:
+            logger.error("Job %s (%s) moved to dead letter after %d attempts: %s", item["key"], name, item["attempts"], error)
+            stats["dead"] += 1
+            await asyncio.to_thread(queue.bury, item["key"], error)
+        else:
+            # Back off exponentially between attempts
+            delay = settings.jobs_retry_delay * 2 ** (item["attempts"] - 1)
+            logger.warning("Job %s (%s) failed, retrying in %.1fs: %s", item["key"], name, delay, error)
+            stats["retried"] += 1
+            await asyncio.to_thread(queue.retry, item["key"], delay, error)
+    else:
+        stats["succeeded"] += 1
+        await asyncio.to_thread(queue.complete, item["key"])
+    finally:
+        stats["total_seconds"] += time.monotonic() - started
+
+# Define the worker loop that claims and runs jobs until cancelled
+async def _worker():
+    while True:
+        # Claiming may wait on the database lock held by another process, so keep it off the event loop
+        item = await asyncio.to_thread(queue.claim, settings.jobs_lease_seconds)
+        if item is None:
+            # Sleep until a job is enqueued or the poll interval passes (for delayed retries and expired leases)
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=settings.jobs_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _run(item)
+
+# Start the worker pool; jobs left running by workers that died are claimed again once their lease expires
+async def start():
+    global _wakeup, _loop
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    for _ in range(settings.jobs_workers):
+        _workers.append(asyncio.create_task(_worker()))
+
+# Stop the worker pool, handing running jobs back to the queue
+async def stop():
+    global _loop
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _loop = None
+
+# Get the per-job metrics together with the queue depth by state
+def stats():
+    return {"jobs": metrics, "queue": queue.counts()}
@@ -0,0 +1,77 @@
+# inventory_contention.py
+# Measure reservation throughput against one hot product, with and without sharded stock.
+#
+#   python benchmarks/inventory_contention.py --stock 500 --threads 32 --shards 8
+#
+# Runs against the Deta project configured for the app, creating and deleting its own product.
+# To run it offline against the emulator with realistic round trips:
+#
+#   APP_DETA_EMULATOR=1 APP_EMULATOR_LATENCY_MS=20 APP_EMULATOR_JITTER_MS=10 python benchmarks/inventory_contention.py
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from db import base, crud, schemas
+
+
+# Reserve one unit at a time until the product runs out, returning (reservations made, false out of stock reports)
+def drain(product_key: str):
+    reserved = spurious = 0
+    while True:
+        try:
+            crud.reserve_stock(product_key, "user_benchmark", 1)
+        except crud.OutOfStockError:
+            # Count out of stock reports made while stock remained, rather than hiding them
+            if crud.get_stock(product_key) <= 0:
+                return reserved, spurious
+            spurious += 1
+            continue
+        reserved += 1
+
+# Run one round of the benchmark and print its results
+def run(stock: int, threads: int, shards: int):
+    product = crud.create_product(schemas.ProductCreate(
+        name="benchmark",
+        description="inventory contention benchmark",
+        price=1.0,
+        image="",
+        category=schemas.CategoryCreate(name="benchmark", description="benchmark"),
+        stock=stock,
+    ))
+    try:
+        if shards:
+            crud.shard_stock(product.key, shards)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            results = list(pool.map(drain, [product.key] * threads))
+        elapsed = time.perf_counter() - started
+        reserved = sum(result[0] for result in results)
+        spurious = sum(result[1] for result in results)
+        label = f"{shards} shards" if shards else "unsharded"
+        print(f"{label:>12}: {reserved}/{stock} reserved in {elapsed:.2f}s ({reserved / elapsed:.1f} reservations/s), "
+              f"{spurious} false out of stock reports")
+        if reserved != stock:
+            print(f"{label:>12}: expected {stock} reservations, got {reserved}")
+    finally:
+        # Clean up the product, its shards and its reservations
+        for reservation in base.reservations_db.fetch({"product_key": product.key}).items:
+            base.reservations_db.delete(reservation["key"])
+            base.reservations_db.delete(f"claim_{reservation['key']}")
+        for i in range(shards):
+            base.stock_shards_db.delete(f"{product.key}_shard_{i}")
+        base.products_db.delete(product.key)
+        base.categories_db.delete(product.category.key)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inventory contention benchmark")
+    parser.add_argument("--stock", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--shards", type=int, default=8)
+    args = parser.parse_args()
+    run(args.stock, args.threads, 0)
+    run(args.stock, args.threads, args.shards)